@@ -1,5 +1,5 @@
+import asyncio
 import logging
-import subprocess
 
 from fastapi import APIRouter, Response
 
@@ -19,18 +19,21 @@ async def show_device_info():
 
     Commands:
      - Uses 'wlanpi-model -b' to query the device model.
-     - Uses '/usr/bin/hostname' to query the device hostname.
+     - Uses the system hostname and resolver to query the device hostname.
      - Uses '/etc/wlanpi-release' to query the device software version.
      - Uses '/etc/wlanpi-state' to query the device mode.
     """
 
     try:
-        # get output of wlanpi-model
-        model = system_service.get_platform()
-        hostname = system_service.get_hostname()
+        # the lookups are independent and block on subprocess, resolver or
+        # file I/O, so run them side by side off the event loop
+        model, hostname, software_ver, mode = await asyncio.gather(
+            asyncio.to_thread(system_service.get_platform),
+            asyncio.to_thread(system_service.get_hostname),
+            asyncio.to_thread(system_service.get_image_ver),
+            asyncio.to_thread(system_service.get_mode),
+        )
         name = hostname.split(".")[0]
-        software_ver = system_service.get_image_ver()
-        mode = system_service.get_mode()
 
         return {
             "model": model,
@@ -57,7 +60,7 @@ async def device_stats():
 
     try:
         # get system stats
-        stats = system_service.get_stats()
+        stats = await system_service.get_stats()
 
         return stats
 
@@ -74,20 +77,16 @@ async def show_device_model():
     Uses 'wlanpi-model -b' to query the device model.
     """
 
-    # get output of wlanpi-model
-    model_cmd = "wlanpi-model -b"
     try:
-        platform = subprocess.check_output(model_cmd, shell=True).decode().strip()
-
-        if platform.endswith("?"):
-            platform = "Unknown"
+        # get output of wlanpi-model
+        platform = system_service.get_platform()
 
         return {"model": platform}
 
     except ValidationError as ve:
         return Response(content=ve.error_msg, status_code=ve.status_code)
-    except subprocess.CalledProcessError as exc:
-        log.error(exc)
+    except Exception as ex:
+        log.error(ex)
         return Response(content="Internal Server Error", status_code=500)
 
 
@@ -23,7 +23,7 @@ async def reachability():
     """
 
     try:
-        reachability = utils_service.show_reachability()
+        reachability = await utils_service.show_reachability()
 
         if reachability.get("error"):
             return Response(
@@ -12,6 +12,7 @@ from starlette.staticfiles import StaticFiles
 from wlanpi_core.__version__ import __license__, __license_url__, __version__
 from wlanpi_core.api.api_v1.api import api_router
 from wlanpi_core.core.config import endpoints, settings
+from wlanpi_core.services import utils_service
 from wlanpi_core.views import api
 
 # setup logger
@@ -50,4 +51,6 @@ def create_app():
     )
     app.include_router(api.router)
 
+    app.add_event_handler("shutdown", utils_service.close_http_client)
+
     return app
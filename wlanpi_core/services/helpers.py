@@ -3,8 +3,10 @@ shared resources between services
 """
 
 import asyncio
+import functools
 import subprocess
-from typing import Union
+import time
+from typing import Any, Callable, Sequence, Union
 
 from wlanpi_core.models.runcommand_error import RunCommandError
 
@@ -14,6 +16,7 @@ IW_FILE = "/sbin/iw"
 IP_FILE = "/usr/sbin/ip"
 UFW_FILE = "/usr/sbin/ufw"
 ETHTOOL_FILE = "/sbin/ethtool"
+LSUSB_FILE = "/usr/bin/lsusb"
 
 # Mode changer scripts
 MODE_FILE = "/etc/wlanpi-state"
@@ -61,12 +64,67 @@ async def run_cli_async(cmd: str, want_stderr: bool = False) -> str:
         )
 
 
-def run_command(cmd) -> Union[str, None]:
+def ttl_cached(
+    seconds: float,
+) -> Callable[[Callable[[], dict[str, Any]]], Callable[[], dict[str, Any]]]:
+    """
+    Reuses a service function's result dict for the given number of seconds
+    so that burst polling doesn't rerun it. Results carrying an "error" key
+    are not cached.
+    """
+
+    def decorator(func: Callable[[], dict[str, Any]]) -> Callable[[], dict[str, Any]]:
+        cache: dict[str, tuple[float, dict[str, Any]]] = {}
+
+        @functools.wraps(func)
+        def wrapper() -> dict[str, Any]:
+            now = time.monotonic()
+            cached = cache.get("result")
+            if cached and cached[0] > now:
+                return cached[1]
+            result = func()
+            if result and not result.get("error"):
+                cache["result"] = (now + seconds, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def run_command(cmd: Union[str, Sequence[str]]) -> Union[str, None]:
     """
     Runs the given command, and handles errors and formatting.
+
+    A string is run through the shell; a list or tuple of arguments is
+    executed directly, which skips the extra sh process.
     """
     try:
-        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
+        output = subprocess.check_output(
+            cmd, shell=isinstance(cmd, str), stderr=subprocess.DEVNULL
+        )
         return output.decode().strip()
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+async def run_command_async(cmd: Union[str, Sequence[str]]) -> Union[str, None]:
+    """
+    Runs the given command without blocking the event loop, and handles
+    errors and formatting the same way as run_command.
+    """
+    try:
+        if isinstance(cmd, str):
+            proc = await asyncio.create_subprocess_shell(
+                cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+    except OSError:
+        return None
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
         return None
+    return stdout.decode().strip()
@@ -13,6 +13,24 @@ from .helpers import (
     PUBLICIP_CMD,
 )
 
+# Interface name and details from each ifconfig -a block
+IFCONFIG_INTERFACE_RE = re.compile(
+    r"^(\w+?)\: flags(.*?)RX packets", re.DOTALL | re.MULTILINE
+)
+
+# IPv4 address within an ifconfig block
+IFCONFIG_INET_RE = re.compile("inet (.+?) ")
+
+# Wireless interface names that may be in monitor mode
+WLAN_MON_INTERFACE_RE = re.compile(r"(wlan\d+)|(mon\d+)")
+
+# Fields of ethtool -i and iw <interface> info output
+ETHTOOL_DRIVER_RE = re.compile(r".*driver:\s+(.*)")
+IW_ADDR_RE = re.compile(r".*addr\s+(.*)")
+IW_TYPE_RE = re.compile(r".*type\s+(.*)")
+IW_SSID_RE = re.compile(r".*ssid\s+(.*)")
+IW_FREQ_RE = re.compile(r".*\(([0-9]+)\s+MHz\).*")
+
 
 def show_info():
     output = {}
@@ -47,9 +65,7 @@ def show_interfaces():
         return interfaces
 
     # Extract interface info with a bit of regex magic
-    interface_re = re.findall(
-        r"^(\w+?)\: flags(.*?)RX packets", ifconfig_info, re.DOTALL | re.MULTILINE
-    )
+    interface_re = IFCONFIG_INTERFACE_RE.findall(ifconfig_info)
     if interface_re is None:
         # Something broke is our regex - report an issue
         interfaces["error"] = "match error"
@@ -63,26 +79,22 @@ def show_interfaces():
             interface_info = result[1]
 
             # determine interface status
-            status = (
-                "UP"
-                if re.search("UP", interface_info, re.MULTILINE) is not None
-                else "DOWN"
-            )
+            status = "UP" if "UP" in interface_info else "DOWN"
 
             # determine IP address
-            inet_search = re.search("inet (.+?) ", interface_info, re.MULTILINE)
+            inet_search = IFCONFIG_INET_RE.search(interface_info)
             if inet_search is None:
                 ip_address = "-"
 
                 # do check if this is an interface in monitor mode
-                if re.search(r"(wlan\d+)|(mon\d+)", interface_name, re.MULTILINE):
+                if WLAN_MON_INTERFACE_RE.search(interface_name):
                     # fire up 'iw' for this interface (hmmm..is this a bit of an un-necessary ovehead?)
                     try:
                         iw_info = subprocess.check_output(
                             "{} {} info".format(iw_file, interface_name), shell=True
                         ).decode()
 
-                        if re.search("type monitor", iw_info, re.MULTILINE):
+                        if "type monitor" in iw_info:
                             ip_address = "Monitor"
                     except:
                         ip_address = "-"
@@ -143,7 +155,7 @@ def show_wlan_interfaces():
                 .decode()
                 .strip()
             )
-            driver = re.search(".*driver:\s+(.*)", ethtool_output).group(1)
+            driver = ETHTOOL_DRIVER_RE.search(ethtool_output).group(1)
             output[interface]["driver"] = driver
         except Exception:
             pass
@@ -158,19 +170,14 @@ def show_wlan_interfaces():
 
             # Addr
             try:
-                addr = (
-                    re.search(".*addr\s+(.*)", iw_output)
-                    .group(1)
-                    .replace(":", "")
-                    .upper()
-                )
+                addr = IW_ADDR_RE.search(iw_output).group(1).replace(":", "").upper()
                 output[interface]["addr"] = addr
             except Exception:
                 pass
 
             # Mode
             try:
-                mode = re.search(".*type\s+(.*)", iw_output).group(1)
+                mode = IW_TYPE_RE.search(iw_output).group(1)
                 output[interface]["mode"] = {
                     mode.capitalize() if not mode.isupper() else mode
                 }
@@ -179,14 +186,14 @@ def show_wlan_interfaces():
 
             # SSID
             try:
-                ssid = re.search(".*ssid\s+(.*)", iw_output).group(1)
+                ssid = IW_SSID_RE.search(iw_output).group(1)
                 output[interface]["ssid"] = ssid
             except Exception:
                 pass
 
             # Frequency
             try:
-                freq = int(re.search(".*\(([0-9]+)\s+MHz\).*", iw_output).group(1))
+                freq = int(IW_FREQ_RE.search(iw_output).group(1))
                 channel = channel_lookup(freq)
                 output[interface]["freq"] = freq
                 output[interface]["channel"] = channel
@@ -1,152 +1,295 @@
-import json
+import asyncio
 import os
+import re
+import shutil
 import socket
 import subprocess
+import time
+from functools import lru_cache
+from typing import Any, Union
 
 from dbus import Interface, SystemBus
 from dbus.exceptions import DBusException
 
 from wlanpi_core.models.validation_error import ValidationError
 
-bus = SystemBus()
-systemd = bus.get_object("org.freedesktop.systemd1", "/org/freedesktop/systemd1")
-manager = Interface(systemd, dbus_interface="org.freedesktop.systemd1.Manager")
-
-allowed_services = [
-    "wlanpi-profiler",
-    "wlanpi-fpms",
-    "wlanpi-chat-bot",
-    "bt-agent",
-    "bt-network",
-    "iperf",
-    "iperf3",
-    "tftpd-hpa",
-    "hostapd",
-    "wpa_supplicant",
-    "kismet",
-    "grafana-server",
-    "cockpit",
-    "wlanpi-grafana-scanner",
-    "wlanpi-grafana-health",
-    "wlanpi-grafana-internet",
-    "wlanpi-grafana-wispy-24",
-    "wlanpi-grafana-wispy-5",
-    "wlanpi-grafana-wipry-lp-24",
-    "wlanpi-grafana-wipry-lp-5",
-    "wlanpi-grafana-wipry-lp-6",
-    "wlanpi-grafana-wipry-lp-stop",
-    "wpa_supplicant",
-    "wpa_supplicant@wlan0",
-]
+from .helpers import MODE_FILE, WLANPI_IMAGE_FILE
+
+allowed_services = frozenset(
+    {
+        "wlanpi-profiler",
+        "wlanpi-fpms",
+        "wlanpi-chat-bot",
+        "bt-agent",
+        "bt-network",
+        "iperf",
+        "iperf3",
+        "tftpd-hpa",
+        "hostapd",
+        "wpa_supplicant",
+        "kismet",
+        "grafana-server",
+        "cockpit",
+        "wlanpi-grafana-scanner",
+        "wlanpi-grafana-health",
+        "wlanpi-grafana-internet",
+        "wlanpi-grafana-wispy-24",
+        "wlanpi-grafana-wispy-5",
+        "wlanpi-grafana-wipry-lp-24",
+        "wlanpi-grafana-wipry-lp-5",
+        "wlanpi-grafana-wipry-lp-6",
+        "wlanpi-grafana-wipry-lp-stop",
+        "wpa_supplicant@wlan0",
+    }
+)
 
 PLATFORM_UNKNOWN = "Unknown"
 
-# Mode changer scripts
-MODE_FILE = "/etc/wlanpi-state"
+# Kernel interfaces used for system stats
+PROC_STAT_FILE = "/proc/stat"
+PROC_MEMINFO_FILE = "/proc/meminfo"
+PROC_UPTIME_FILE = "/proc/uptime"
+
+# CPU temperature in millidegrees Celsius
+THERMAL_ZONE_FILE = "/sys/class/thermal/thermal_zone0/temp"
+
+# Seconds between the two /proc/stat samples used to work out CPU load
+CPU_SAMPLE_INTERVAL = 0.2
+
+# Seconds a service status is served from cache, by service name prefix.
+# Long-running daemons rarely change state on their own; test tools like
+# iperf come and go, so they are re-checked sooner.
+SERVICE_STATUS_TTLS = {
+    "grafana-server": 30,
+    "wlanpi-grafana": 30,
+    "cockpit": 30,
+    "hostapd": 15,
+    "iperf": 2,
+}
+SERVICE_STATUS_DEFAULT_TTL = 5
+
+# {unit name: (expiry in time.monotonic() seconds, running)}
+service_status_cache: dict[str, tuple[float, bool]] = {}
+
+# Unit states that are about to change, so they are never cached
+TRANSITIONAL_ACTIVE_STATES = frozenset(("activating", "deactivating", "reloading"))
 
-# Version file for WLAN Pi image
-WLANPI_IMAGE_FILE = "/etc/wlanpi-release"
+# Image version and platform don't change while we run, so successful
+# lookups are kept here; failures are retried on the next call
+device_info_cache: dict[str, str] = {}
 
+# Matches the VERSION line of the WLAN Pi release file
+VERSION_RE = re.compile(rb'^VERSION=[ \t"]*([^"\n]+)', re.MULTILINE)
 
-def get_mode():
+
+@lru_cache(maxsize=1)
+def _system_bus() -> SystemBus:
+    """
+    Returns the system bus connection, opened on first use
+    """
+    # private, so a dropped connection can be closed and replaced
+    return SystemBus(private=True)
+
+
+@lru_cache(maxsize=1)
+def _manager() -> Interface:
+    """
+    Returns the systemd Manager interface, connecting to the system bus on
+    first use and reusing that connection for every later call.
+    """
+    systemd = _system_bus().get_object(
+        "org.freedesktop.systemd1", "/org/freedesktop/systemd1"
+    )
+    return Interface(systemd, dbus_interface="org.freedesktop.systemd1.Manager")
+
+
+def _call_manager(method: str, *args: Any) -> Any:
+    """
+    Calls a systemd Manager method, reconnecting and retrying once if the
+    system bus connection has gone away (e.g. dbus was restarted)
+    """
+    try:
+        return getattr(_manager(), method)(*args)
+    except DBusException as de:
+        if de._dbus_error_name != "org.freedesktop.DBus.Error.Disconnected":
+            raise
+    _system_bus().close()
+    _system_bus.cache_clear()
+    _manager.cache_clear()
+    return getattr(_manager(), method)(*args)
+
+
+def get_mode() -> str:
     valid_modes = ["classic", "wconsole", "hotspot", "wiperf", "server", "bridge"]
 
-    # check mode file exists and read mode...create with classic mode if not
-    if os.path.isfile(MODE_FILE):
+    # read mode from the mode file...create with classic mode if it does not exist
+    try:
         with open(MODE_FILE, "r") as f:
             current_mode = f.readline().strip()
-
-        # send msg to stdout & exit if mode invalid
-        if not current_mode in valid_modes:
-            print(
-                "The mode read from {} is not a valid mode of operation: {}".format(
-                    MODE_FILE, current_mode
-                )
-            )
-            # sys.exit()
-    else:
+    except FileNotFoundError:
         # create the mode file as it does not exist
         with open(MODE_FILE, "w") as f:
             current_mode = "classic"
             f.write(current_mode)
+        return current_mode
+
+    # send msg to stdout & exit if mode invalid
+    if not current_mode in valid_modes:
+        print(
+            "The mode read from {} is not a valid mode of operation: {}".format(
+                MODE_FILE, current_mode
+            )
+        )
+        # sys.exit()
 
     return current_mode
 
 
-def get_image_ver():
-    wlanpi_ver = "unknown"
+def get_image_ver() -> str:
+    wlanpi_ver = device_info_cache.get("image_ver")
+    if wlanpi_ver:
+        return wlanpi_ver
 
-    if os.path.isfile(WLANPI_IMAGE_FILE):
-        with open(WLANPI_IMAGE_FILE, "r") as f:
-            lines = f.readlines()
+    try:
+        with open(WLANPI_IMAGE_FILE, "rb") as f:
+            release = f.read()
+    except OSError:
+        return "unknown"
+
+    # pull out the version number for the FPMS home page
+    version = VERSION_RE.search(release)
+    if not version:
+        return "unknown"
+
+    wlanpi_ver = version.group(1).decode().strip()
+    device_info_cache["image_ver"] = wlanpi_ver
+    return wlanpi_ver
 
-        # pull out the version number for the FPMS home page
-        for line in lines:
-            (name, value) = line.split("=")
-            if name == "VERSION":
-                wlanpi_ver = value.strip()
-                break
 
-    return wlanpi_ver
+def get_hostname() -> str:
+    hostname = socket.gethostname()
+    if not "." in hostname:
+        domain = "local"
+        # same resolver lookup 'hostname -d' does, without forking it
+        fqdn = socket.getfqdn(hostname)
+        if "." in fqdn:
+            domain = fqdn.split(".", 1)[1]
+        hostname = f"{hostname}.{domain}"
+    return hostname
 
 
-def get_hostname():
-    try:
-        hostname = (
-            subprocess.check_output("/usr/bin/hostname", shell=True).decode().strip()
-        )
-        if not "." in hostname:
-            domain = "local"
-            try:
-                output = (
-                    subprocess.check_output("/usr/bin/hostname -d", shell=True)
-                    .decode()
-                    .strip()
-                )
-                if len(output) != 0:
-                    domain = output
-            except:
-                pass
-            hostname = f"{hostname}.{domain}"
-        return hostname
-    except:
-        pass
-
-    return None
-
-
-def get_platform():
+def get_platform() -> str:
     """
     Method to determine which platform we're running on.
-    Uses output of "cat /proc/cpuinfo"
+    Uses output of "wlanpi-model -b"
 
-    Possible strings seen in the wild:
+    The board model alone (/proc/device-tree/model) is not enough, several
+    WLAN Pi models share the same compute module:
 
         Pro:    Raspberry Pi Compute Module 4
         RPi3b+: Raspberry Pi 3 Model B Plus Rev 1.3
         RPi4:   Raspberry Pi 4 Model B Rev 1.1
 
-    Errors sent to stdout, but will not exit on error
+    Errors are not raised, the platform is reported as unknown instead
     """
-
-    platform = PLATFORM_UNKNOWN
+    platform = device_info_cache.get("platform")
+    if platform:
+        return platform
 
     # get output of wlanpi-model
-    model_cmd = "wlanpi-model -b"
     try:
-        platform = subprocess.check_output(model_cmd, shell=True).decode().strip()
-    except subprocess.CalledProcessError as exc:
-        exc.model.decode()
-        # print("Err: issue running 'wlanpi-model -b' : ", model)
-        return "Unknown"
+        platform = subprocess.check_output(["wlanpi-model", "-b"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return PLATFORM_UNKNOWN
 
-    if platform.endswith("?"):
-        platform = PLATFORM_UNKNOWN
+    if not platform or platform.endswith("?"):
+        return PLATFORM_UNKNOWN
 
+    device_info_cache["platform"] = platform
     return platform
 
 
-def get_stats():
+def _read_cpu_times() -> tuple[int, int]:
+    """
+    Returns (idle, total) jiffies from the aggregate cpu line in /proc/stat
+    """
+    with open(PROC_STAT_FILE, "r") as f:
+        fields = [int(field) for field in f.readline().split()[1:9]]
+    return fields[3], sum(fields)
+
+
+async def get_cpu_idle(interval: float = CPU_SAMPLE_INTERVAL) -> float:
+    """
+    Returns the CPU idle percentage over the sample interval
+    """
+    idle_start, total_start = _read_cpu_times()
+    await asyncio.sleep(interval)
+    idle_end, total_end = _read_cpu_times()
+
+    total = total_end - total_start
+    if total <= 0:
+        return 100.0
+    return (idle_end - idle_start) * 100 / total
+
+
+def get_mem_usage() -> str:
+    """
+    Returns memory usage as "used/totalMB percent%" from /proc/meminfo
+    """
+    meminfo = {}
+    with open(PROC_MEMINFO_FILE, "r") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            meminfo[name] = int(value.split()[0])
+
+    total = meminfo["MemTotal"] // 1024
+    used = total - meminfo["MemAvailable"] // 1024
+    return "{}/{}MB {:.2f}%".format(used, total, used * 100 / total)
+
+
+@lru_cache(maxsize=1)
+def _thermal_zone_fd() -> int:
+    return os.open(THERMAL_ZONE_FILE, os.O_RDONLY)
+
+
+def get_cpu_temp() -> float:
+    """
+    Returns the CPU temperature in degrees Celsius. sysfs regenerates the
+    value on every read, so the file is opened once and read with pread.
+    """
+    return int(os.pread(_thermal_zone_fd(), 16, 0)) / 1000
+
+
+def get_disk_usage() -> str:
+    """
+    Returns root filesystem usage as "used/totalGB percent%", rounding the
+    percentage up the same way df does
+    """
+    usage = shutil.disk_usage("/")
+    percent = -(-usage.used * 100 // (usage.used + usage.free))
+    return "{}/{}GB {}%".format(usage.used >> 30, usage.total >> 30, percent)
+
+
+def get_uptime() -> str:
+    """
+    Returns uptime in the compact 'uptime -p' style, e.g. "1w 2d 3h 4m"
+    """
+    with open(PROC_UPTIME_FILE, "r") as f:
+        minutes = int(float(f.read().split()[0])) // 60
+
+    weeks, minutes = divmod(minutes, 7 * 24 * 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+
+    parts = [
+        f"{value}{unit}"
+        for value, unit in ((weeks, "w"), (days, "d"), (hours, "h"), (minutes, "m"))
+        if value
+    ]
+    return " ".join(parts) or "0m"
+
+
+async def get_stats() -> dict[str, str]:
     # figure out our IP
     IP = ""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -162,11 +305,8 @@ def get_stats():
     ipStr = f"{IP}"
 
     # determine CPU load
-    # cmd = "top -bn1 | grep load | awk '{printf \"%.2f%%\", $(NF-2)}'"
-    cmd = "mpstat 1 1 -o JSON | grep idle"
     try:
-        CPU_JSON = subprocess.check_output(cmd, shell=True).decode()
-        CPU_IDLE = json.loads(CPU_JSON)["idle"]
+        CPU_IDLE = await get_cpu_idle()
         CPU = "{0:.2f}%".format(100 - CPU_IDLE)
         if CPU_IDLE == 100:
             CPU = "0%"
@@ -176,33 +316,26 @@ def get_stats():
         CPU = "unknown"
 
     # determine mem useage
-    cmd = "free -m | awk 'NR==2{printf \"%s/%sMB %.2f%%\", $3,$2,$3*100/$2 }'"
     try:
-        MemUsage = subprocess.check_output(cmd, shell=True).decode()
+        MemUsage = get_mem_usage()
     except Exception:
         MemUsage = "unknown"
 
     # determine disk util
-    cmd = 'df -h | awk \'$NF=="/"{printf "%d/%dGB %s", $3,$2,$5}\''
     try:
-        Disk = subprocess.check_output(cmd, shell=True).decode()
+        Disk = get_disk_usage()
     except Exception:
         Disk = "unknown"
 
     # determine temp
     try:
-        tempI = int(open("/sys/class/thermal/thermal_zone0/temp").read())
+        tempStr = "%sC" % str(round(get_cpu_temp(), 1))
     except Exception:
-        tempI = "unknown"
-
-    if tempI > 1000:
-        tempI = tempI / 1000
-    tempStr = "%sC" % str(round(tempI, 1))
+        tempStr = "unknown"
 
     # determine uptime
-    cmd = "uptime -p | sed -r 's/up|,//g' | sed -r 's/\s*week[s]?/w/g' | sed -r 's/\s*day[s]?/d/g' | sed -r 's/\s*hour[s]?/h/g' | sed -r 's/\s*minute[s]?/m/g'"
     try:
-        uptime = subprocess.check_output(cmd, shell=True).decode().strip()
+        uptime = get_uptime()
     except Exception:
         uptime = "unknown"
 
@@ -220,56 +353,97 @@ def get_stats():
     return results
 
 
-def is_allowed_service(service: str):
-    for allowed_service in allowed_services:
-        if service.replace(".service", "") == allowed_service:
-            return True
-    return False
+def canonical_service_name(name: str) -> str:
+    """
+    Normalises a requested service name to its allow list form,
+    e.g. " Hostapd.service" -> "hostapd"
+    """
+    return name.strip().lower().removesuffix(".service")
 
 
-def check_service_status(service: str):
+def is_allowed_service(service: str) -> bool:
+    return service in allowed_services
+
+
+def get_service_status_ttl(service: str) -> int:
+    for prefix, ttl in SERVICE_STATUS_TTLS.items():
+        if service.startswith(prefix):
+            return ttl
+    return SERVICE_STATUS_DEFAULT_TTL
+
+
+def invalidate_service_status(service: str) -> None:
+    """
+    Drops a cached status so the next check queries systemd
     """
-    Queries systemd through dbus to see if the service is running
+    service_status_cache.pop(service, None)
 
-    You can list services from the CLI like this: systemctl list-unit-files --type=service
+
+def check_service_status(service: str) -> bool:
+    """
+    Returns whether the service is running, served from a short-lived cache
+    so repeated polling does not query systemd every time.
     """
-    service_running = False
+    service = f"{service}.service"
+
+    now = time.monotonic()
+    cached = service_status_cache.get(service)
+    if cached and cached[0] > now:
+        return cached[1]
+
     try:
-        if ".service" not in service:
-            service = service + ".service"
-        service_proxy = bus.get_object(
-            "org.freedesktop.systemd1", object_path=manager.GetUnit(service)
-        )
-        service_props = Interface(
-            service_proxy, dbus_interface="org.freedesktop.DBus.Properties"
+        active_state = query_service_status(service)
+    except DBusException:
+        # report a transient bus failure as not running, but don't cache it
+        return False
+
+    service_running = active_state == "active"
+    # a unit that is starting or stopping is re-checked on the next poll
+    if active_state not in TRANSITIONAL_ACTIVE_STATES:
+        service_status_cache[service] = (
+            now + get_service_status_ttl(service),
+            service_running,
         )
-        service_load_state = service_props.Get(
-            "org.freedesktop.systemd1.Unit", "LoadState"
-        )
-        service_active_state = service_props.Get(
-            "org.freedesktop.systemd1.Unit", "ActiveState"
-        )
-        if service_load_state == "loaded" and service_active_state == "active":
-            service_running = True
+    return service_running
+
+
+def query_service_status(service: str) -> str:
+    """
+    Queries systemd through dbus for the service's ActiveState, e.g.
+    "active" or "activating". Units that are not loaded are "inactive".
+
+    You can list services from the CLI like this: systemctl list-unit-files --type=service
+    """
+    active_state = "inactive"
+    try:
+        # one round-trip returns (name, description, load state, active state, ...)
+        units = _call_manager("ListUnitsByNames", [service])
+        if not units:
+            return active_state
+        service_load_state, service_active_state = units[0][2:4]
+        # a "not-found" unit (e.g. not installed) is reported as not running,
+        # as GetUnit's "not loaded" error was
+        if service_load_state == "loaded":
+            active_state = str(service_active_state)
     except DBusException as de:
         if de.args:
             if "not loaded" in de.args[0]:
-                return service_running
+                return active_state
         if de._dbus_error_name == "org.freedesktop.systemd1.NoSuchUnit":
             raise ValidationError(
                 f"no such unit for {service} on host", status_code=503
             )
+        raise
     except ValueError as error:
         raise ValidationError(f"{error}", status_code=400)
-    return service_running
+    return active_state
 
 
-async def get_systemd_service_status(name: str):
+async def get_systemd_service_status(name: str) -> dict[str, Union[str, bool]]:
     """
     Queries systemd via dbus to get the current status of an allowed service.
     """
-    status = ""
-    name = name.strip().lower()
+    name = canonical_service_name(name)
     if is_allowed_service(name):
         status = check_service_status(name)
         return {"name": name, "active": status}
@@ -279,12 +453,11 @@ async def get_systemd_service_status(name: str):
     )
 
 
-def stop_service(service: str):
+def stop_service(service: str) -> bool:
     try:
-        if ".service" not in service:
-            service = service + ".service"
-        manager.StopUnit(service, "replace")
-        # manager.DisableUnitFiles([service], Boolean(False))
+        service = f"{service}.service"
+        _call_manager("StopUnit", service, "replace")
+        invalidate_service_status(service)
     except DBusException as de:
         if de._dbus_error_name == "org.freedesktop.systemd1.NoSuchUnit":
             raise ValidationError(
@@ -302,12 +475,11 @@ def stop_service(service: str):
     return False
 
 
-async def stop_systemd_service(name: str):
+async def stop_systemd_service(name: str) -> dict[str, Union[str, bool]]:
     """
     Queries systemd via dbus to get the current status of an allowed service.
     """
-    status = ""
-    name = name.strip().lower()
+    name = canonical_service_name(name)
     if is_allowed_service(name):
         status = stop_service(name)
         return {"name": name, "active": status}
@@ -317,12 +489,11 @@ async def stop_systemd_service(name: str):
     )
 
 
-def start_service(service: str):
+def start_service(service: str) -> bool:
     try:
-        if ".service" not in service:
-            service = service + ".service"
-        # manager.EnableUnitFiles([service], Boolean(False), Boolean(True))
-        manager.StartUnit(service, "replace")
+        service = f"{service}.service"
+        _call_manager("StartUnit", service, "replace")
+        invalidate_service_status(service)
     except DBusException as de:
         if de._dbus_error_name == "org.freedesktop.systemd1.NoSuchUnit":
             raise ValidationError(
@@ -340,9 +511,8 @@ def start_service(service: str):
     return True
 
 
-async def start_systemd_service(name: str):
-    status = ""
-    name = name.strip().lower()
+async def start_systemd_service(name: str) -> dict[str, Union[str, bool]]:
+    name = canonical_service_name(name)
     if is_allowed_service(name):
         status = start_service(name)
         return {"name": name, "active": status}
@@ -1,173 +1,523 @@
+import asyncio
+import itertools
 import os
 import re
+import select
+import socket
+import struct
 import subprocess
+import time
+from typing import Any, Optional
 
-from .helpers import run_command
+import httpx
 
-UFW_FILE = "/usr/sbin/ufw"
+from .helpers import LSUSB_FILE, UFW_FILE, run_command_async, ttl_cached
 
+# Average round trip time from the ping summary line
+PING_RTT_RE = re.compile(r"rtt min/avg/max/mdev = \S+/(\S+)/\S+/\S+ ms")
 
-def show_reachability():
+# Round trip time from arping output
+ARPING_RTT_RE = re.compile(r"\d+ms")
+
+# Device description from each lsusb line, skipping Linux Foundation root hubs
+LSUSB_RE = re.compile(
+    r"^Bus \d+ Device \d+: ID [0-9a-f]{4}:[0-9a-f]{4} (?!Linux)(.*\S)", re.MULTILINE
+)
+
+# Actions in ufw status output, and the direction that can follow one
+UFW_ACTIONS = frozenset(("ALLOW", "DENY", "REJECT", "LIMIT"))
+UFW_DIRECTIONS = frozenset(("IN", "OUT", "FWD"))
+
+# Seconds to reuse the usb and ufw results for, to absorb burst polling
+USB_UFW_CACHE_TTL = 1.0
+
+# Kernel IPv4 routing table, and the RTF_GATEWAY route flag
+ROUTE_FILE = "/proc/net/route"
+RTF_GATEWAY = 0x2
+
+# Resolver configuration, and its nameservers cached against the file's stat
+RESOLV_CONF_FILE = "/etc/resolv.conf"
+resolv_conf_cache: dict[str, Any] = {"key": None, "servers": []}
+
+
+def get_default_route() -> tuple[Optional[str], Optional[str]]:
     """
-    Check if default gateway, internet and DNS are reachable and working
+    Returns (gateway, interface) of the first default route in the kernel
+    routing table, or (None, None) if there is no default gateway
     """
+    with open(ROUTE_FILE, "r") as f:
+        # skip the header line
+        next(f, None)
+        for line in f:
+            fields = line.split()
+            # Iface, Destination, Gateway, Flags, ... Mask, ...
+            if fields[1] != "00000000" or fields[7] != "00000000":
+                continue
+            if not int(fields[3], 16) & RTF_GATEWAY:
+                continue
+            # addresses are little-endian hex, e.g. 0101A8C0 -> 192.168.1.1
+            gateway = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
+            return gateway, fields[0]
+    return None, None
 
-    output = {"results": {}}
 
-    # --- Variables ---
+def get_dns_servers() -> list[str]:
+    """
+    Returns the nameservers listed in resolv.conf, only re-reading the file
+    when it has been rewritten or replaced since the last call
+    """
+    st = os.stat(RESOLV_CONF_FILE)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if key != resolv_conf_cache["key"]:
+        servers = []
+        with open(RESOLV_CONF_FILE, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == "nameserver":
+                    servers.append(fields[1])
+        resolv_conf_cache.update(key=key, servers=servers)
+    return resolv_conf_cache["servers"]
+
+
+# ICMP echo message types
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# Seconds to wait for each reachability probe
+PROBE_TIMEOUT = 2
+
+# Fallback probe commands, run directly rather than through a shell
+PING_ARGV = ("ping", "-n", "-c1", f"-W{PROBE_TIMEOUT}", "-q")
+ARPING_ARGV = ("timeout", str(PROBE_TIMEOUT), "arping", "-c1", f"-w{PROBE_TIMEOUT}")
+
+# Seconds to reuse a resolved ping target address, e.g. for google.com
+PING_HOST_CACHE_TTL = 300
+ping_host_cache: dict[str, tuple[float, str]] = {}
+
+
+def resolve_ping_host(host: str) -> str:
+    """
+    Returns the IPv4 address of host, reusing a recent successful lookup
+    """
+    now = time.monotonic()
+    cached = ping_host_cache.get(host)
+    if cached and cached[0] > now:
+        return cached[1]
+    address = socket.gethostbyname(host)
+    ping_host_cache[host] = (now + PING_HOST_CACHE_TTL, address)
+    return address
+
+
+def _icmp_checksum(data: bytes) -> int:
+    """
+    RFC 1071 internet checksum
+    """
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _icmp_ping(address: str, timeout: float = PROBE_TIMEOUT) -> Optional[float]:
+    """
+    Sends a single ICMP echo request over an unprivileged ping socket and
+    returns the round trip time in ms, or None if no reply arrived in time.
+    Raises PermissionError if ping sockets are not allowed for this process.
+    """
+    seq = os.getpid() & 0xFFFF
+    payload = b"wlanpi-core"
+    # the kernel replaces the identifier with the socket's own id
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, 0, seq)
+    checksum = _icmp_checksum(header + payload)
+    packet = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, 0, seq) + payload
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP) as sock:
+        send_ts = time.perf_counter()
+        sock.sendto(packet, (address, 0))
+        deadline = send_ts + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([sock], [], [], remaining)
+            if not ready:
+                return None
+            data, _ = sock.recvfrom(1024)
+            recv_ts = time.perf_counter()
+            icmp_type, _, _, _, reply_seq = struct.unpack("!BBHHH", data[:8])
+            if icmp_type == ICMP_ECHO_REPLY and reply_seq == seq:
+                return (recv_ts - send_ts) * 1000
+
+
+async def _ping_rtt(host: str) -> Optional[str]:
+    """
+    Returns the round trip time to host, e.g. "12.345ms", or None if it did
+    not answer. Falls back to the ping binary if ping sockets are not allowed.
+    """
+    loop = asyncio.get_running_loop()
     try:
-        default_gateway = (
-            subprocess.check_output(
-                "ip route | grep 'default' | grep -E -o '([0-9]{1,3}[\\.]){3}[0-9]{1,3}' | head -n1",
-                shell=True,
-            )
-            .decode()
-            .strip()
+        address = await loop.run_in_executor(None, resolve_ping_host, host)
+        rtt = await loop.run_in_executor(None, _icmp_ping, address)
+    except PermissionError:
+        output = await run_command_async([*PING_ARGV, address])
+        rtt_match = PING_RTT_RE.search(output) if output else None
+        return f"{rtt_match.group(1)}ms" if rtt_match else None
+    except OSError:
+        return None
+    return f"{rtt:.3f}ms" if rtt is not None else None
+
+
+# Shared HTTP client, so repeat probes reuse a kept-alive connection
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared HTTP client, creating it on first use
+    """
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=PROBE_TIMEOUT,
+            limits=httpx.Limits(max_connections=4, keepalive_expiry=60),
         )
+    return http_client
+
+
+async def close_http_client() -> None:
+    """
+    Closes the shared HTTP client and its pooled connections
+    """
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+async def _check_http(url: str, domain: str) -> bool:
+    """
+    Returns True if a HEAD request to url (following redirects) succeeds and
+    ends up on domain, rather than e.g. on a captive portal's login page
+    """
+    try:
+        response = await get_http_client().head(url)
+    except httpx.HTTPError:
+        return False
+    host = response.url.host
+    on_domain = host == domain or host.endswith(f".{domain}")
+    return on_domain and response.status_code < 400
+
+
+# DNS port, record type and class for the nameserver resolution check
+DNS_PORT = 53
+DNS_TYPE_NS = 2
+DNS_CLASS_IN = 1
+
+
+class _DnsQueryProtocol(asyncio.DatagramProtocol):
+    """
+    Resolves answered with whether the response to a single DNS query
+    carried any answers
+    """
 
-        dg_interface = (
-            subprocess.check_output(
-                "ip route | grep 'default' | head -n1 | cut -d ' ' -f5", shell=True
-            )
-            .decode()
-            .strip()
+    def __init__(self, query_id: int, answered: "asyncio.Future[bool]") -> None:
+        self.query_id = query_id
+        self.answered = answered
+
+    def datagram_received(self, data: bytes, addr: Any) -> None:
+        if len(data) < 12 or self.answered.done():
+            return
+        query_id, flags, _, ancount, _, _ = struct.unpack("!HHHHHH", data[:12])
+        # ignore anything that isn't the response to our query
+        if query_id != self.query_id or not flags & 0x8000:
+            return
+        # RCODE 0 (NOERROR) with at least one answer record
+        self.answered.set_result(flags & 0xF == 0 and ancount > 0)
+
+    def error_received(self, exc: Exception) -> None:
+        if not self.answered.done():
+            self.answered.set_result(False)
+
+
+async def _dns_query(
+    server: str, name: str, qtype: int = DNS_TYPE_NS, timeout: float = PROBE_TIMEOUT
+) -> bool:
+    """
+    Returns True if the DNS server answers a recursive query for name
+    """
+    loop = asyncio.get_running_loop()
+    query_id = int.from_bytes(os.urandom(2), "big")
+    # header with recursion desired and one question, then the question
+    query = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    for label in name.split("."):
+        query += bytes([len(label)]) + label.encode()
+    query += b"\x00" + struct.pack("!HH", qtype, DNS_CLASS_IN)
+
+    answered: "asyncio.Future[bool]" = loop.create_future()
+    try:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DnsQueryProtocol(query_id, answered),
+            remote_addr=(server, DNS_PORT),
         )
+    except OSError:
+        return False
+    try:
+        transport.sendto(query)
+        return await asyncio.wait_for(answered, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        transport.close()
+
+
+async def show_reachability() -> dict[str, Any]:
+    """
+    Check if default gateway, internet and DNS are reachable and working
+    """
+
+    output: dict[str, Any] = {"results": {}}
 
-        dns_servers = [
-            line.split()[1]
-            for line in open("/etc/resolv.conf")
-            if line.startswith("nameserver")
-        ]
-    except subprocess.CalledProcessError:
+    # --- Variables ---
+    try:
+        default_gateway, dg_interface = get_default_route()
+
+        dns_servers = get_dns_servers()
+    except (OSError, IndexError, ValueError):
         return {"error": "Failed to determine network configuration"}
 
     # --- Checks ---
-    if not default_gateway:
+    if not default_gateway or not dg_interface:
         return {"error": "No default gateway"}
 
+    # Every probe is independent, so run them all at once and wait only as
+    # long as the slowest one
+    dns_servers = dns_servers[:3]
+    (
+        ping_google,
+        browse_google,
+        ping_gateway,
+        arping_gateway,
+        *dns_results,
+    ) = await asyncio.gather(
+        _ping_rtt("google.com"),
+        _check_http("http://www.google.com", "google.com"),
+        _ping_rtt(default_gateway),
+        run_command_async([*ARPING_ARGV, "-I", dg_interface, default_gateway]),
+        *(_dns_query(dns, "google.com") for dns in dns_servers),
+        return_exceptions=True,
+    )
+
     # Ping Google
-    ping_google = run_command("ping -c1 -W2 -q google.com")
-    try:
-        ping_google_rtt = re.search(
-            r"rtt min/avg/max/mdev = \S+/(\S+)/\S+/\S+ ms", ping_google
-        )
-        output["results"]["Ping Google"] = (
-            f"{ping_google_rtt.group(1)}ms" if ping_google_rtt else None
-        )
-    except:
-        output["results"]["Ping Google"] = "FAIL"
+    output["results"]["Ping Google"] = (
+        ping_google if isinstance(ping_google, str) else "FAIL"
+    )
 
     # Browse Google.com
-    browse_google = run_command(
-        "timeout 2 curl -s -L www.google.com | grep 'google.com'"
-    )
-    output["results"]["Browse Google"] = "OK" if browse_google is not None else "FAIL"
+    output["results"]["Browse Google"] = "OK" if browse_google is True else "FAIL"
 
     # Ping default gateway
-    ping_gateway = run_command(f"ping -c1 -W2 -q {default_gateway}")
-    try:
-        ping_gateway_rtt = re.search(
-            r"rtt min/avg/max/mdev = \S+/(\S+)/\S+/\S+ ms", ping_gateway
-        )
-        output["results"]["Ping Gateway"] = (
-            f"{ping_gateway_rtt.group(1)}ms" if ping_gateway_rtt else None
-        )
-    except:
-        output["results"]["Ping Gateway"] = "FAIL"
+    output["results"]["Ping Gateway"] = (
+        ping_gateway if isinstance(ping_gateway, str) else "FAIL"
+    )
 
     # DNS resolution checks
-    for i, dns in enumerate(dns_servers[:3], start=1):
-        dns_res = run_command(f"dig +short +time=2 +tries=1 @{dns} NS google.com")
-        if dns_res:
+    for i, dns_res in enumerate(dns_results, start=1):
+        if dns_res is True:
             output["results"][f"DNS Server {i} Resolution"] = "OK"
 
     # ARPing default gateway
-    arping_gateway = run_command(
-        f"timeout 2 arping -c1 -w2 -I {dg_interface} {default_gateway} 2>/dev/null"
+    arping_rtt = (
+        ARPING_RTT_RE.search(arping_gateway)
+        if isinstance(arping_gateway, str)
+        else None
     )
-    arping_rtt = re.search(r"\d+ms", arping_gateway)
     output["results"]["Arping Gateway"] = arping_rtt.group(0) if arping_rtt else "FAIL"
 
     return output
 
 
-def show_usb():
+@ttl_cached(USB_UFW_CACHE_TTL)
+def show_usb() -> dict[str, Any]:
     """
     Return a list of non-Linux USB interfaces found with the lsusb command
     """
 
-    lsusb = r"/usr/bin/lsusb | /bin/grep -v Linux | /usr/bin/cut -d\  -f7-"
-    lsusb_info = []
-
-    interfaces = {}
+    interfaces: dict[str, Any] = {}
 
     try:
-        lsusb_output = subprocess.check_output(lsusb, shell=True).decode()
-        lsusb_info = lsusb_output.split("\n")
-    except subprocess.CalledProcessError:
+        lsusb_output = subprocess.check_output([LSUSB_FILE]).decode()
+    except (subprocess.CalledProcessError, OSError):
         error_descr = "Issue getting usb info using lsusb command"
-        interfaces["error"] = {"error": {error_descr}}
+        interfaces["error"] = {"error": error_descr}
         return interfaces
 
-    interfaces["interfaces"] = []
+    interfaces["interfaces"] = LSUSB_RE.findall(lsusb_output)
 
-    for result in (result for result in lsusb_info if result != ""):
-        interfaces["interfaces"].append(result)
-
-    if len(interfaces) == 0:
+    if not interfaces["interfaces"]:
         interfaces["interfaces"].append("No devices detected")
 
     return interfaces
 
 
-def parse_ufw(output):
+def parse_ufw(output: str) -> dict[str, Any]:
     """
     Parses the output of the UFW file into readable json for the api.
     """
 
-    lines = output.strip().split("\n")
+    lines = iter(output.strip().splitlines())
+
+    status_line = next(lines, "")
+    status = status_line.partition(":")[2].strip()
+
+    # skip the blank line and column headers before the rules
+    parsed_rules = []
+    for rule in itertools.islice(lines, 2, None):
+        parts = rule.split()
+
+        # the action separates To and From, which can both span several
+        # words, e.g. "Apache Full (v6)" or "Anywhere on eth0"
+        start = next((i for i, part in enumerate(parts) if part in UFW_ACTIONS), 0)
+        end = start + 1
+        if end < len(parts) and parts[end] in UFW_DIRECTIONS:
+            end += 1
+        if not start or end >= len(parts):
+            continue
+
+        parsed_rules.append(
+            {
+                "To": " ".join(parts[:start]),
+                "Action": " ".join(parts[start:end]),
+                "From": " ".join(parts[end:]),
+            }
+        )
+    final_output = {"status": status, "ports": parsed_rules}
+    return final_output
+
+
+# ufw's own configuration and rule files, and the marker for each rule tuple
+UFW_CONF_FILE = "/etc/ufw/ufw.conf"
+UFW_RULES_FILES = ("/etc/ufw/user.rules", "/etc/ufw/user6.rules")
+UFW_TUPLE_PREFIX = "### tuple ###"
 
-    status_line = lines[0]
-    status = status_line.split(":")[1].strip()
 
-    # Check if there are at least 3 lines (status + headers + at least one rule)
-    if len(lines) <= 3:
-        # No rules present in the output
-        parsed_rules = []
+def _format_ufw_endpoint(
+    address: str, port: str, proto: str, app: str, v6: bool
+) -> str:
+    """
+    Formats one side of a ufw rule the way "ufw status" prints it
+    """
+    if app != "-":
+        endpoint = app.replace("%20", " ")
+    elif address in ("0.0.0.0/0", "::/0"):
+        endpoint = "Anywhere" if port == "any" else port
     else:
-        rules = lines[3:]
-        parsed_rules = []
-
-        # IPv6 pattern detection: "XX (v6)" followed by "ALLOW" and "Anywhere (v6)"
-        ipv6_pattern = re.compile(r"\(v6\)")
-
-        for rule in rules:
-            parts = rule.split()
-
-            if len(parts) >= 3 and (parts[1] == "ALLOW" or parts[1] == "DENY"):
-                to = parts[0]
-                action = parts[1]
-                from_ = " ".join(parts[2:])
-            elif len(parts) >= 4 and ipv6_pattern.search(rule):
-                to = " ".join(parts[0:2])
-                action = parts[2]
-                from_ = " ".join(parts[3:])
+        endpoint = address if port == "any" else f"{address} {port}"
+    if app == "-" and port != "any" and proto != "any":
+        endpoint += f"/{proto}"
+    if v6:
+        endpoint += " (v6)"
+    return endpoint
+
+
+def _parse_ufw_rules_file(path: str, v6: bool = False) -> list[dict[str, str]]:
+    """
+    Parses the rule tuples ufw records in user.rules/user6.rules into the
+    same {"To", "Action", "From"} entries parse_ufw builds
+    """
+    rules = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.startswith(UFW_TUPLE_PREFIX):
+                continue
+            fields = [
+                field
+                for field in line.removeprefix(UFW_TUPLE_PREFIX).split()
+                if not field.startswith("comment=")
+            ]
+            # action proto dport dst sport src [dapp sapp] direction
+            if len(fields) == 9:
+                action, proto, dport, dst, sport, src, dapp, sapp, direction = fields
+            elif len(fields) == 7:
+                action, proto, dport, dst, sport, src, direction = fields
+                dapp = sapp = "-"
             else:
                 continue
 
-            parsed_rules.append({"To": to, "Action": action, "From": from_})
-    final_output = {"status": status, "ports": parsed_rules}
-    return final_output
+            to = _format_ufw_endpoint(dst, dport, proto, dapp, v6)
+            from_ = _format_ufw_endpoint(src, sport, proto, sapp, v6)
+
+            # e.g. "allow", "limit_log" or "route:deny_log-all"
+            route, _, action = action.rpartition(":")
+            action, _, logtype = action.partition("_")
+            action = action.upper()
+
+            # "in" or "out" with an optional interface, e.g. "out_eth0"; route
+            # rules can give both interfaces, e.g. "in_eth0!out_eth1"
+            interfaces = {}
+            for part in direction.split("!"):
+                side, _, interface = part.partition("_")
+                interfaces[side] = interface
+            if route:
+                action += " FWD"
+                # forwarded traffic comes from the in interface and goes to
+                # the out interface
+                to_interface = interfaces.get("out")
+                from_interface = interfaces.get("in")
+            else:
+                if "out" in interfaces:
+                    action += " OUT"
+                to_interface = interfaces.get("in")
+                from_interface = interfaces.get("out")
+            if to_interface:
+                to += f" on {to_interface}"
+            if from_interface:
+                from_ += f" on {from_interface}"
+            if logtype:
+                from_ += f" ({logtype})"
+
+            rule = {"To": to, "Action": action, "From": from_}
+            # like "ufw status", list an application rule once even if its
+            # profile needed several tuples
+            if (dapp != "-" or sapp != "-") and rule in rules:
+                continue
+            rules.append(rule)
+    return rules
 
 
-def show_ufw():
+def read_ufw_rules() -> dict[str, Any]:
+    """
+    Builds the ufw status and rules from ufw's configuration files, without
+    running ufw itself
+    """
+    enabled = False
+    with open(UFW_CONF_FILE, "r") as f:
+        for line in f:
+            key, _, value = line.strip().partition("=")
+            if key == "ENABLED":
+                enabled = value.strip().strip("\"'").lower() == "yes"
+
+    # like "ufw status", an inactive firewall lists no rules
+    ports = []
+    if enabled:
+        for v6, path in enumerate(UFW_RULES_FILES):
+            ports.extend(_parse_ufw_rules_file(path, v6=bool(v6)))
+        # and lists route rules after all the others
+        ports.sort(key=lambda rule: rule["Action"].endswith(" FWD"))
+
+    return {"status": "active" if enabled else "inactive", "ports": ports}
+
+
+@ttl_cached(USB_UFW_CACHE_TTL)
+def show_ufw() -> dict[str, Any]:
     """
     Return a list ufw ports
     """
     ufw_file = UFW_FILE
-    ufw_info = []
 
-    response = {}
+    response: dict[str, Any] = {}
 
     # check ufw is available
     if not os.path.isfile(ufw_file):
@@ -176,15 +526,19 @@ def show_ufw():
         return response
 
     try:
-        ufw_output = subprocess.check_output(
-            "sudo {} status".format(ufw_file), shell=True
-        ).decode()
+        return read_ufw_rules()
+    except OSError:
+        # fall back to asking ufw if its files can't be read
+        pass
+
+    try:
+        ufw_output = subprocess.check_output([ufw_file, "status"]).decode()
         ufw_info = parse_ufw(ufw_output)
 
     except:
         error_descr = "Issue getting ufw info using ufw command"
         response["error"] = {"error": error_descr}
-        return
+        return response
 
     # Add in status line
 
@@ -0,0 +1,173 @@
+import pathlib
+import subprocess
+from typing import Any, Iterator
+
+import pytest
+from dbus.exceptions import DBusException
+
+from wlanpi_core.services import system_service
+
+
+class FakeManager:
+    """
+    Stands in for _call_manager, tracking the ActiveState of a single unit
+    """
+
+    def __init__(self) -> None:
+        self.load_state = "loaded"
+        self.active_state = "inactive"
+
+    def __call__(self, method: str, *args: Any) -> Any:
+        if method == "StartUnit":
+            # systemd queues the job and the unit passes through activating
+            self.active_state = "activating"
+            return "/org/freedesktop/systemd1/job/1"
+        if method == "StopUnit":
+            self.active_state = "deactivating"
+            return "/org/freedesktop/systemd1/job/2"
+        if method == "ListUnitsByNames":
+            (name,) = args[0]
+            return [
+                (name, "", self.load_state, self.active_state, "", "", "/", 0, "", "/")
+            ]
+        raise AssertionError(f"unexpected Manager call {method}")
+
+
+@pytest.fixture
+def manager(monkeypatch: pytest.MonkeyPatch) -> FakeManager:
+    fake = FakeManager()
+    monkeypatch.setattr(system_service, "_call_manager", fake)
+    monkeypatch.setattr(system_service, "service_status_cache", {})
+    return fake
+
+
+class FakeBus:
+    """
+    Stands in for SystemBus; the first connection has been dropped
+    """
+
+    instances: list["FakeBus"] = []
+
+    def __init__(self, private: bool = False) -> None:
+        self.disconnected = not FakeBus.instances
+        self.closed = False
+        FakeBus.instances.append(self)
+
+    def get_object(self, bus_name: str, object_path: str) -> "FakeBus":
+        return self
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeInterface:
+    def __init__(self, bus: FakeBus, dbus_interface: str) -> None:
+        self.bus = bus
+
+    def ListUnitsByNames(self, names: list[str]) -> list[tuple[Any, ...]]:
+        if self.bus.disconnected:
+            raise DBusException(
+                "Connection was disconnected before a reply was received",
+                name="org.freedesktop.DBus.Error.Disconnected",
+            )
+        return []
+
+
+@pytest.fixture
+def system_bus(monkeypatch: pytest.MonkeyPatch) -> Iterator[list[FakeBus]]:
+    monkeypatch.setattr(system_service, "SystemBus", FakeBus)
+    monkeypatch.setattr(system_service, "Interface", FakeInterface)
+    monkeypatch.setattr(FakeBus, "instances", [])
+    system_service._system_bus.cache_clear()
+    system_service._manager.cache_clear()
+    yield FakeBus.instances
+    system_service._system_bus.cache_clear()
+    system_service._manager.cache_clear()
+
+
+def test_start_then_status_is_not_cached_while_activating(
+    manager: FakeManager,
+) -> None:
+    assert system_service.start_service("grafana-server") is True
+    assert system_service.check_service_status("grafana-server") is False
+
+    manager.active_state = "active"
+    assert system_service.check_service_status("grafana-server") is True
+
+
+def test_stop_then_status_is_not_cached_while_deactivating(
+    manager: FakeManager,
+) -> None:
+    manager.active_state = "active"
+    assert system_service.check_service_status("cockpit") is True
+
+    system_service.stop_service("cockpit")
+    assert system_service.check_service_status("cockpit") is False
+
+    manager.active_state = "inactive"
+    assert system_service.check_service_status("cockpit") is False
+    assert "cockpit.service" in system_service.service_status_cache
+
+
+def test_settled_status_is_cached(manager: FakeManager) -> None:
+    manager.active_state = "active"
+    assert system_service.check_service_status("grafana-server") is True
+
+    # within the TTL the cached answer is served without asking systemd
+    manager.active_state = "failed"
+    assert system_service.check_service_status("grafana-server") is True
+
+
+def test_not_installed_service_is_not_running(manager: FakeManager) -> None:
+    # systemd still lists units it can't find, with a "not-found" load state
+    manager.load_state = "not-found"
+    assert system_service.query_service_status("kismet.service") == "inactive"
+    assert system_service.check_service_status("kismet") is False
+
+
+def test_platform_failure_is_not_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(system_service, "device_info_cache", {})
+
+    def missing(*args: object, **kwargs: object) -> bytes:
+        raise FileNotFoundError("wlanpi-model")
+
+    monkeypatch.setattr(subprocess, "check_output", missing)
+    assert system_service.get_platform() == system_service.PLATFORM_UNKNOWN
+
+    monkeypatch.setattr(subprocess, "check_output", lambda *a, **kw: b"Pro\n")
+    assert system_service.get_platform() == "Pro"
+
+    # a successful lookup is kept for later calls
+    monkeypatch.setattr(subprocess, "check_output", missing)
+    assert system_service.get_platform() == "Pro"
+
+
+def test_image_ver_failure_is_not_cached(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    release = tmp_path / "wlanpi-release"
+    monkeypatch.setattr(system_service, "device_info_cache", {})
+    monkeypatch.setattr(system_service, "WLANPI_IMAGE_FILE", str(release))
+    assert system_service.get_image_ver() == "unknown"
+
+    release.write_text('VERSION="3.2.0"\n')
+    assert system_service.get_image_ver() == "3.2.0"
+
+
+def test_empty_version_line_does_not_match_next_line(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    release = tmp_path / "wlanpi-release"
+    release.write_text("VERSION=\nID=foo\n")
+    monkeypatch.setattr(system_service, "device_info_cache", {})
+    monkeypatch.setattr(system_service, "WLANPI_IMAGE_FILE", str(release))
+    assert system_service.get_image_ver() == "unknown"
+
+
+def test_call_manager_reconnects_after_disconnect(system_bus: list[FakeBus]) -> None:
+    assert system_service._call_manager("ListUnitsByNames", ["cockpit.service"]) == []
+
+    # the dropped connection is closed and the call retried on a new one
+    dropped, reconnected = system_bus
+    assert dropped.closed
+    assert not reconnected.closed
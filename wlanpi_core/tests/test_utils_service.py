@@ -0,0 +1,138 @@
+import asyncio
+import pathlib
+
+import httpx
+import pytest
+
+from wlanpi_core.services import utils_service
+
+USER_RULES = """\
+*filter
+:ufw-user-input - [0:0]
+:ufw-user-output - [0:0]
+### RULES ###
+
+### tuple ### allow tcp 22 0.0.0.0/0 any 0.0.0.0/0 in
+-A ufw-user-input -p tcp --dport 22 -j ACCEPT
+
+### tuple ### allow tcp 80,443 0.0.0.0/0 any 0.0.0.0/0 Apache%20Full - in
+-A ufw-user-input -p tcp -m multiport --dports 80,443 -j ACCEPT
+
+### tuple ### allow_log tcp 8080 0.0.0.0/0 any 0.0.0.0/0 in
+-A ufw-user-input -p tcp --dport 8080 -j ufw-user-logging-input
+-A ufw-user-input -p tcp --dport 8080 -j ACCEPT
+
+### tuple ### deny_log-all any any 0.0.0.0/0 any 10.0.0.5 in
+-A ufw-user-input -s 10.0.0.5 -j ufw-user-logging-input
+-A ufw-user-input -s 10.0.0.5 -j DROP
+
+### tuple ### limit tcp 2222 0.0.0.0/0 any 0.0.0.0/0 in
+-A ufw-user-input -p tcp --dport 2222 -m conntrack --ctstate NEW -m recent --set
+-A ufw-user-input -p tcp --dport 2222 -j ufw-user-limit-accept
+
+### tuple ### allow udp 53 0.0.0.0/0 any 0.0.0.0/0 out_eth0
+-A ufw-user-output -o eth0 -p udp --dport 53 -j ACCEPT
+
+### tuple ### allow any 80 0.0.0.0/0 any 0.0.0.0/0 in_eth1
+-A ufw-user-input -i eth1 -p tcp --dport 80 -j ACCEPT
+-A ufw-user-input -i eth1 -p udp --dport 80 -j ACCEPT
+
+### tuple ### route:allow any any 0.0.0.0/0 any 0.0.0.0/0 in_eth0!out_eth1
+-A ufw-user-forward -i eth0 -o eth1 -j ACCEPT
+
+### END RULES ###
+COMMIT
+"""
+
+USER6_RULES = """\
+*filter
+### RULES ###
+
+### tuple ### allow tcp 22 ::/0 any ::/0 in
+-A ufw6-user-input -p tcp --dport 22 -j ACCEPT
+
+### tuple ### allow tcp 80,443 ::/0 any ::/0 Apache%20Full - in
+-A ufw6-user-input -p tcp -m multiport --dports 80,443 -j ACCEPT
+
+### tuple ### allow udp 53 ::/0 any ::/0 out_eth0
+-A ufw6-user-output -o eth0 -p udp --dport 53 -j ACCEPT
+
+### tuple ### route:allow any any ::/0 any ::/0 in_eth0!out_eth1
+-A ufw6-user-forward -i eth0 -o eth1 -j ACCEPT
+
+### END RULES ###
+COMMIT
+"""
+
+UFW_STATUS = """\
+Status: active
+
+To                         Action      From
+--                         ------      ----
+22/tcp                     ALLOW       Anywhere
+Apache Full                ALLOW       Anywhere
+8080/tcp                   ALLOW       Anywhere                   (log)
+Anywhere                   DENY        10.0.0.5                   (log-all)
+2222/tcp                   LIMIT       Anywhere
+53/udp                     ALLOW OUT   Anywhere on eth0
+80 on eth1                 ALLOW       Anywhere
+22/tcp (v6)                ALLOW       Anywhere (v6)
+Apache Full (v6)           ALLOW       Anywhere (v6)
+53/udp (v6)                ALLOW OUT   Anywhere (v6) on eth0
+Anywhere on eth1           ALLOW FWD   Anywhere on eth0
+Anywhere (v6) on eth1      ALLOW FWD   Anywhere (v6) on eth0
+"""
+
+
+@pytest.fixture
+def ufw_files(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    conf = tmp_path / "ufw.conf"
+    conf.write_text("# /etc/ufw/ufw.conf\nENABLED=yes\nLOGLEVEL=low\n")
+    user_rules = tmp_path / "user.rules"
+    user_rules.write_text(USER_RULES)
+    user6_rules = tmp_path / "user6.rules"
+    user6_rules.write_text(USER6_RULES)
+    monkeypatch.setattr(utils_service, "UFW_CONF_FILE", str(conf))
+    monkeypatch.setattr(
+        utils_service, "UFW_RULES_FILES", (str(user_rules), str(user6_rules))
+    )
+
+
+def test_rules_files_match_ufw_status(ufw_files: None) -> None:
+    assert utils_service.read_ufw_rules() == utils_service.parse_ufw(UFW_STATUS)
+
+
+def test_rules_file_formats_logged_out_and_route_rules(ufw_files: None) -> None:
+    ports = utils_service.read_ufw_rules()["ports"]
+
+    assert {"To": "8080/tcp", "Action": "ALLOW", "From": "Anywhere (log)"} in ports
+    assert {"To": "2222/tcp", "Action": "LIMIT", "From": "Anywhere"} in ports
+    assert {"To": "53/udp", "Action": "ALLOW OUT", "From": "Anywhere on eth0"} in ports
+    assert ports[-2] == {
+        "To": "Anywhere on eth1",
+        "Action": "ALLOW FWD",
+        "From": "Anywhere on eth0",
+    }
+
+
+def test_check_http_fails_when_redirected_off_domain(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def captive_portal(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "www.google.com":
+            return httpx.Response(302, headers={"Location": "http://portal.lan/"})
+        return httpx.Response(200)
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(captive_portal), follow_redirects=True
+    )
+    monkeypatch.setattr(utils_service, "http_client", client)
+    check = utils_service._check_http("http://www.google.com", "google.com")
+    assert asyncio.run(check) is False
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200))
+    )
+    monkeypatch.setattr(utils_service, "http_client", client)
+    check = utils_service._check_http("http://www.google.com", "google.com")
+    assert asyncio.run(check) is True